@@ -1,37 +1,70 @@
-from odoo import models, fields, api
-import requests
-import json
-import os
-
-class AIAgent(models.Model):
-    _name = 'ai.agent'
-    _description = 'AI Agent'
-    _inherit = ['mail.thread', 'mail.activity.mixin']
-
-    name = fields.Char(string='Name', default='AI Assistant', required=True)
-    active = fields.Boolean(default=True)
-    state = fields.Selection([
-        ('draft', 'Draft'),
-        ('active', 'Active'),
-        ('archived', 'Archived')
-    ], default='active', string='Status')
-    
-    @api.model
-    def send_message(self, message):
-        """Send a message to the AI agent and get the response"""
-        try:
-            # Get the AI agent URL from environment variable or use default
-            ai_agent_url = os.getenv('AI_AGENT_URL', 'http://localhost:8000')
-            response = requests.post(
-                f'{ai_agent_url}/chat',
-                json={'message': message},
-                timeout=30  # Add timeout to prevent hanging
-            )
-            if response.status_code == 200:
-                return response.json().get('response', '')
-            else:
-                return f"Error: {response.status_code} - {response.text}"
-        except requests.exceptions.ConnectionError:
-            return "Error: Could not connect to AI agent service. Please make sure it's running."
-        except Exception as e:
+from odoo import models, fields, api
+import requests
+import json
+import logging
+import os
+
+_logger = logging.getLogger(__name__)
+
+class AIAgent(models.Model):
+    _name = 'ai.agent'
+    _description = 'AI Agent'
+    _inherit = ['mail.thread', 'mail.activity.mixin']
+
+    name = fields.Char(string='Name', default='AI Assistant', required=True)
+    active = fields.Boolean(default=True)
+    state = fields.Selection([
+        ('draft', 'Draft'),
+        ('active', 'Active'),
+        ('archived', 'Archived')
+    ], default='active', string='Status')
+    
+    @api.model
+    def get_context_snapshot(self, queries):
+        """Run a batch of read queries in a single RPC round-trip.
+
+        ``queries`` is a list of ``[section, key, model, method, args,
+        kwargs]`` entries mirroring execute_kw calls; the result is
+        ``{section: {key: rows}}``. Collecting everything server-side saves
+        the AI agent service one HTTP round-trip per query. Only the read
+        methods below may be batched: this is a public RPC method, and an
+        open getattr dispatch would let callers reach private methods that
+        execute_kw itself refuses.
+        """
+        allowed_methods = ('search_read', 'read_group', 'search_count')
+        result = {}
+        for section, key, model, method, args, kwargs in queries:
+            if method not in allowed_methods:
+                raise ValueError(
+                    "get_context_snapshot only batches %s, got %r"
+                    % (', '.join(allowed_methods), method))
+            try:
+                # Savepoint per query: a SQL error would otherwise abort
+                # the whole transaction and fail every query after it
+                with self.env.cr.savepoint():
+                    rows = getattr(self.env[model], method)(*args, **(kwargs or {}))
+                result.setdefault(section, {})[key] = rows
+            except Exception:
+                _logger.exception("Context snapshot query failed: %s.%s", model, method)
+                continue
+        return result
+
+    @api.model
+    def send_message(self, message):
+        """Send a message to the AI agent and get the response"""
+        try:
+            # Get the AI agent URL from environment variable or use default
+            ai_agent_url = os.getenv('AI_AGENT_URL', 'http://localhost:8000')
+            response = requests.post(
+                f'{ai_agent_url}/chat',
+                json={'message': message},
+                timeout=30  # Add timeout to prevent hanging
+            )
+            if response.status_code == 200:
+                return response.json().get('response', '')
+            else:
+                return f"Error: {response.status_code} - {response.text}"
+        except requests.exceptions.ConnectionError:
+            return "Error: Could not connect to AI agent service. Please make sure it's running."
+        except Exception as e:
             return f"Error: {str(e)}" 
\ No newline at end of file
@@ -1,419 +1,948 @@
-from fastapi import FastAPI, HTTPException
-from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List, Optional, Any, Dict
-import os
-from dotenv import load_dotenv
-import xmlrpc.client
-import anthropic
-import logging
-import json
-
-# Configure logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
-
-# Load environment variables
-load_dotenv()
-
-app = FastAPI()
-
-# Configure CORS
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["http://localhost:8069"],  # Odoo frontend URL
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-# Odoo connection settings
-ODOO_URL = os.getenv("ODOO_URL", "http://web:8069")
-ODOO_DB = os.getenv("ODOO_DB", "HISEY")
-ODOO_USERNAME = os.getenv("ODOO_USERNAME", "cjhisey@gmail.com")
-ODOO_PASSWORD = os.getenv("ODOO_PASSWORD", "odoo")
-
-# Anthropic settings
-ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
-if not ANTHROPIC_API_KEY:
-    raise ValueError("ANTHROPIC_API_KEY environment variable is not set")
-
-class ChatMessage(BaseModel):
-    message: str
-    context: Optional[dict] = None
-    conversation_history: Optional[List[dict]] = None
-
-class DatabaseOperation(BaseModel):
-    model: str
-    method: str
-    args: List[Any]
-    kwargs: Dict[str, Any] = {}
-
-def connect_to_odoo():
-    """Establish connection to Odoo instance"""
-    try:
-        logger.info(f"Connecting to Odoo at {ODOO_URL} with database {ODOO_DB}")
-        common = xmlrpc.client.ServerProxy(f'{ODOO_URL}/xmlrpc/2/common')
-        uid = common.authenticate(ODOO_DB, ODOO_USERNAME, ODOO_PASSWORD, {})
-        if not uid:
-            raise Exception("Authentication failed. Please check your credentials and database name.")
-        models = xmlrpc.client.ServerProxy(f'{ODOO_URL}/xmlrpc/2/object')
-        logger.info("Successfully connected to Odoo")
-        return uid, models
-    except Exception as e:
-        logger.error(f"Error connecting to Odoo: {str(e)}")
-        raise
-
-def get_odoo_context():
-    """Get current context from Odoo"""
-    try:
-        logger.info("Connecting to Odoo...")
-        # Connect to Odoo
-        common = xmlrpc.client.ServerProxy(f'{ODOO_URL}/xmlrpc/2/common')
-        uid = common.authenticate(ODOO_DB, ODOO_USERNAME, ODOO_PASSWORD, {})
-        models = xmlrpc.client.ServerProxy(f'{ODOO_URL}/xmlrpc/2/object')
-        
-        logger.info("Fetching data...")
-        context = {}
-        
-        # Check which modules are installed
-        installed_modules = models.execute_kw(ODOO_DB, uid, ODOO_PASSWORD,
-            'ir.module.module', 'search_read',
-            [[['state', '=', 'installed']]],
-            {'fields': ['name']})
-        installed_module_names = [m['name'] for m in installed_modules]
-        logger.info(f"Installed modules: {installed_module_names}")
-        
-        # Define module-specific data fetchers
-        module_fetchers = {
-            'stock': {
-                'name': 'inventory',
-                'fetch': lambda: {
-                    'products': models.execute_kw(ODOO_DB, uid, ODOO_PASSWORD,
-                        'product.product', 'search_read',
-                        [[['type', '=', 'product']]],
-                        {'fields': ['name', 'qty_available', 'virtual_available', 'standard_price']}),
-                    'categories': models.execute_kw(ODOO_DB, uid, ODOO_PASSWORD,
-                        'product.category', 'search_read',
-                        [[]],
-                        {'fields': ['name', 'parent_id']}),
-                }
-            },
-            'mrp': {
-                'name': 'manufacturing',
-                'fetch': lambda: {
-                    'boms': models.execute_kw(ODOO_DB, uid, ODOO_PASSWORD,
-                        'mrp.bom', 'search_read',
-                        [[]],
-                        {'fields': ['product_tmpl_id', 'product_qty', 'code']}),
-                    'workcenters': models.execute_kw(ODOO_DB, uid, ODOO_PASSWORD,
-                        'mrp.workcenter', 'search_read',
-                        [[]],
-                        {'fields': ['name', 'resource_calendar_id', 'time_efficiency']}),
-                    'production_orders': models.execute_kw(ODOO_DB, uid, ODOO_PASSWORD,
-                        'mrp.production', 'search_read',
-                        [[['state', 'in', ['draft', 'confirmed', 'progress']]]],
-                        {'fields': ['name', 'product_id', 'product_qty', 'state']}),
-                }
-            },
-            'sale': {
-                'name': 'sales',
-                'fetch': lambda: {
-                    'orders': models.execute_kw(ODOO_DB, uid, ODOO_PASSWORD,
-                        'sale.order', 'search_read',
-                        [[['state', 'in', ['draft', 'sent', 'sale']]]],
-                        {'fields': ['name', 'partner_id', 'amount_total', 'state', 'date_order']}),
-                    'order_lines': models.execute_kw(ODOO_DB, uid, ODOO_PASSWORD,
-                        'sale.order.line', 'search_read',
-                        [[['order_id.state', 'in', ['draft', 'sent', 'sale']]]],
-                        {'fields': ['order_id', 'product_id', 'product_uom_qty', 'price_unit', 'price_subtotal']}),
-                    'customers': models.execute_kw(ODOO_DB, uid, ODOO_PASSWORD,
-                        'res.partner', 'search_read',
-                        [[['customer_rank', '>', 0]]],
-                        {'fields': ['name', 'email', 'phone', 'street', 'city', 'country_id']}),
-                }
-            },
-            'purchase': {
-                'name': 'purchasing',
-                'fetch': lambda: {
-                    'orders': models.execute_kw(ODOO_DB, uid, ODOO_PASSWORD,
-                        'purchase.order', 'search_read',
-                        [[['state', 'in', ['draft', 'sent', 'purchase']]]],
-                        {'fields': ['name', 'partner_id', 'amount_total', 'state', 'date_order', 'date_planned']}),
-                    'order_lines': models.execute_kw(ODOO_DB, uid, ODOO_PASSWORD,
-                        'purchase.order.line', 'search_read',
-                        [[['order_id.state', 'in', ['draft', 'sent', 'purchase']]]],
-                        {'fields': ['order_id', 'product_id', 'product_qty', 'price_unit', 'price_subtotal']}),
-                    'suppliers': models.execute_kw(ODOO_DB, uid, ODOO_PASSWORD,
-                        'res.partner', 'search_read',
-                        [[['supplier_rank', '>', 0]]],
-                        {'fields': ['name', 'email', 'phone', 'street', 'city', 'country_id']}),
-                }
-            },
-            'account': {
-                'name': 'accounting',
-                'fetch': lambda: {
-                    'invoices': models.execute_kw(ODOO_DB, uid, ODOO_PASSWORD,
-                        'account.move', 'search_read',
-                        [[['move_type', 'in', ['out_invoice', 'in_invoice']], ['state', '!=', 'cancel']]],
-                        {'fields': ['name', 'partner_id', 'amount_total', 'state', 'invoice_date', 'invoice_date_due', 'payment_state']}),
-                    'invoice_lines': models.execute_kw(ODOO_DB, uid, ODOO_PASSWORD,
-                        'account.move.line', 'search_read',
-                        [[['move_id.move_type', 'in', ['out_invoice', 'in_invoice']], ['move_id.state', '!=', 'cancel']]],
-                        {'fields': ['move_id', 'product_id', 'quantity', 'price_unit', 'price_subtotal']}),
-                    'payments': models.execute_kw(ODOO_DB, uid, ODOO_PASSWORD,
-                        'account.payment', 'search_read',
-                        [[['state', '!=', 'cancel']]],
-                        {'fields': ['name', 'partner_id', 'amount', 'payment_type', 'date', 'state']}),
-                }
-            },
-            'crm': {
-                'name': 'crm',
-                'fetch': lambda: {
-                    'leads': models.execute_kw(ODOO_DB, uid, ODOO_PASSWORD,
-                        'crm.lead', 'search_read',
-                        [[['type', '=', 'lead']]],
-                        {'fields': ['name', 'partner_id', 'email_from', 'phone', 'stage_id', 'probability', 'expected_revenue', 'create_date']}),
-                    'opportunities': models.execute_kw(ODOO_DB, uid, ODOO_PASSWORD,
-                        'crm.lead', 'search_read',
-                        [[['type', '=', 'opportunity']]],
-                        {'fields': ['name', 'partner_id', 'email_from', 'phone', 'stage_id', 'probability', 'expected_revenue', 'create_date']}),
-                    'activities': models.execute_kw(ODOO_DB, uid, ODOO_PASSWORD,
-                        'mail.activity', 'search_read',
-                        [[['res_model', '=', 'crm.lead']]],
-                        {'fields': ['res_id', 'activity_type_id', 'summary', 'date_deadline', 'user_id', 'state']}),
-                    'stages': models.execute_kw(ODOO_DB, uid, ODOO_PASSWORD,
-                        'crm.stage', 'search_read',
-                        [[]],
-                        {'fields': ['name', 'sequence', 'is_won']}),
-                }
-            }
-        }
-        
-        # Fetch data for each installed module
-        for module_name, fetcher in module_fetchers.items():
-            if module_name in installed_module_names:
-                try:
-                    logger.info(f"Fetching data for module: {module_name}")
-                    context[fetcher['name']] = fetcher['fetch']()
-                    logger.info(f"Successfully fetched data for {module_name}")
-                except Exception as e:
-                    logger.error(f"Error fetching data for module {module_name}: {str(e)}")
-                    logger.error(f"Error type: {type(e)}")
-                    logger.error(f"Error args: {e.args}")
-                    # Continue with other modules even if one fails
-                    continue
-        
-        logger.info(f"Retrieved context: {context}")
-        return context
-    except Exception as e:
-        logger.error(f"Error getting Odoo context: {str(e)}")
-        logger.error(f"Error type: {type(e)}")
-        logger.error(f"Error args: {e.args}")
-        return {}
-
-def test_anthropic_connection():
-    """Test the connection to Anthropic API"""
-    try:
-        logger.info("Testing Anthropic API connection...")
-        logger.info(f"API Key length: {len(ANTHROPIC_API_KEY)}")
-        logger.info(f"API Key prefix: {ANTHROPIC_API_KEY[:10]}...")
-        
-        client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
-        response = client.messages.create(
-            model="claude-3-5-haiku-20241022",
-            max_tokens=100,
-            messages=[
-                {"role": "user", "content": "Hello, this is a test message."}
-            ]
-        )
-        logger.info("Anthropic API connection successful!")
-        return True
-    except Exception as e:
-        logger.error(f"Anthropic API connection failed: {str(e)}")
-        logger.error(f"Error type: {type(e)}")
-        logger.error(f"Error args: {e.args}")
-        return False
-
-def execute_database_operation(operation: DatabaseOperation):
-    """Execute a database operation safely"""
-    try:
-        logger.info(f"Executing database operation: {operation.model}.{operation.method}")
-        logger.info(f"Args: {operation.args}")
-        logger.info(f"Kwargs: {operation.kwargs}")
-        
-        # Connect to Odoo
-        common = xmlrpc.client.ServerProxy(f'{ODOO_URL}/xmlrpc/2/common')
-        uid = common.authenticate(ODOO_DB, ODOO_USERNAME, ODOO_PASSWORD, {})
-        models = xmlrpc.client.ServerProxy(f'{ODOO_URL}/xmlrpc/2/object')
-        
-        # Execute the operation
-        result = models.execute_kw(
-            ODOO_DB, uid, ODOO_PASSWORD,
-            operation.model,
-            operation.method,
-            operation.args,
-            operation.kwargs
-        )
-        
-        logger.info(f"Operation successful. Result: {result}")
-        return result
-    except Exception as e:
-        logger.error(f"Error executing database operation: {str(e)}")
-        logger.error(f"Error type: {type(e)}")
-        logger.error(f"Error args: {e.args}")
-        raise
-
-def process_with_llm(message: str, context: dict, conversation_history: List[dict] = None):
-    """Process the message with Claude and return a response"""
-    try:
-        logger.info("Initializing Anthropic client...")
-        client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
-        
-        # Convert context to a readable format
-        context_str = ""
-        if context:
-            for section, data in context.items():
-                context_str += f"\n{section.upper()}:\n"
-                for key, items in data.items():
-                    context_str += f"\n{key}:\n"
-                    if isinstance(items, list):
-                        for item in items:
-                            context_str += f"- {item}\n"
-                    else:
-                        context_str += f"- {items}\n"
-        
-        logger.info(f"Formatted context being sent to LLM: {context_str}")
-        
-        system_prompt = f"""You are an AI assistant for an Odoo ERP system. 
-        You have access to the following context about the system:
-        {context_str}
-        
-        Your task is to help users with their ERP operations. You can:
-        1. Answer questions about inventory levels, products, and categories
-        2. Help with manufacturing processes, BOMs, and work centers
-        3. Provide information about sales orders and customers
-        4. Assist with purchase orders and supplier information
-        5. Help with accounting, invoices, and payments
-        6. Provide insights about the data and suggest actions
-        7. Analyze relationships between different aspects of the business
-        8. Make changes to the database when requested
-        
-        When making changes to the database, you should:
-        1. First confirm the change with the user
-        2. Use the appropriate model and method
-        3. Provide clear feedback about what was changed
-        
-        Available write operations:
-        - create: Create new records
-        - write: Update existing records
-        - unlink: Delete records
-        
-        Example operations:
-        - Create a new lead: DATABASE_OPERATION:{{"model": "crm.lead", "method": "create", "args": [[{{"name": "New Lead", "partner_id": 1}}]]}}
-        - Update a lead: DATABASE_OPERATION:{{"model": "crm.lead", "method": "write", "args": [[1], {{"name": "Updated Lead"}}]]}}
-        - Delete a lead: DATABASE_OPERATION:{{"model": "crm.lead", "method": "unlink", "args": [[1]]}}
-        
-        Always be professional and precise in your responses. When providing information:
-        - Use specific numbers and data from the context when available
-        - Explain your reasoning when making suggestions
-        - Highlight any potential issues or concerns
-        - Suggest next steps when appropriate
-        
-        IMPORTANT: Maintain context from previous messages in the conversation. If the user refers to something 
-        mentioned earlier (like a specific lead, customer, or order), use that information to provide relevant responses."""
-        
-        # Prepare messages array with conversation history
-        messages = []
-        if conversation_history:
-            messages.extend(conversation_history)
-        messages.append({"role": "user", "content": message})
-        
-        logger.info("Sending request to Anthropic API...")
-        response = client.messages.create(
-            model="claude-3-5-haiku-20241022",
-            max_tokens=2000,
-            system=system_prompt,
-            messages=messages
-        )
-        logger.info("Received response from Anthropic API")
-        return response.content[0].text
-    except Exception as e:
-        logger.error(f"Error in LLM processing: {str(e)}")
-        logger.error(f"Error type: {type(e)}")
-        logger.error(f"Error args: {e.args}")
-        raise
-
-@app.get("/ping")
-async def ping():
-    """Test endpoint to verify service health"""
-    try:
-        # Test Anthropic API connection
-        anthropic_connected = test_anthropic_connection()
-        
-        # Test Odoo connection
-        try:
-            connect_to_odoo()
-            odoo_connected = True
-        except Exception as e:
-            logger.error(f"Odoo connection failed: {str(e)}")
-            odoo_connected = False
-        
-        return {
-            "status": "ok",
-            "anthropic_connected": anthropic_connected,
-            "odoo_connected": odoo_connected
-        }
-    except Exception as e:
-        logger.error(f"Ping test failed: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
-
-@app.post("/chat")
-async def chat(message: ChatMessage):
-    try:
-        logger.info(f"Received chat message: {message.message}")
-        logger.info(f"Message context: {message.context}")
-        logger.info(f"Conversation history: {message.conversation_history}")
-        
-        # Get current Odoo context
-        logger.info("Fetching Odoo context...")
-        context = get_odoo_context()
-        logger.info(f"Retrieved Odoo context: {context}")
-        
-        # Process the message with LLM
-        logger.info("Processing message with LLM...")
-        response = process_with_llm(message.message, context, message.conversation_history)
-        
-        # Check if the response contains a database operation
-        try:
-            if "DATABASE_OPERATION:" in response:
-                # Extract the JSON part after DATABASE_OPERATION:
-                operation_str = response.split("DATABASE_OPERATION:")[1].strip()
-                # Remove any text after the JSON (in case there's additional text)
-                operation_str = operation_str.split('\n')[0].strip()
-                logger.info(f"Attempting to parse operation: {operation_str}")
-                
-                try:
-                    operation = DatabaseOperation(**json.loads(operation_str))
-                    result = execute_database_operation(operation)
-                    response = response.split("DATABASE_OPERATION:")[0] + f"\nOperation successful: {result}"
-                except json.JSONDecodeError as e:
-                    logger.error(f"JSON parsing error: {str(e)}")
-                    response = f"Error in database operation format. Please ensure the operation is valid JSON. Error: {str(e)}"
-                except Exception as e:
-                    logger.error(f"Error executing database operation: {str(e)}")
-                    response = f"Error executing database operation: {str(e)}"
-        except Exception as e:
-            logger.error(f"Error processing database operation: {str(e)}")
-            response = f"Error processing database operation: {str(e)}"
-        
-        return {"response": response}
-    except Exception as e:
-        logger.error(f"Error in chat endpoint: {str(e)}")
-        logger.error(f"Error type: {type(e)}")
-        logger.error(f"Error args: {e.args}")
-        raise HTTPException(status_code=500, detail=str(e))
-
-if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000) 
\ No newline at end of file
+from fastapi import FastAPI, HTTPException, Depends, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel
+from typing import List, Optional, Any, Dict
+import os
+from dotenv import load_dotenv
+import httpx
+import anthropic
+import logging
+import orjson
+import re
+import time
+import asyncio
+import hashlib
+import heapq
+import hmac
+import itertools
+from contextlib import asynccontextmanager
+
+# Configure logging; level comes from the environment so production can
+# run INFO-only while debugging can opt into the verbose payload dumps
+logging.basicConfig(level=os.getenv("LOGLEVEL", "INFO").upper())
+logger = logging.getLogger(__name__)
+
+# Load environment variables
+load_dotenv()
+
+async def _warmup():
+    """Pre-warm external dependencies at boot; failures are non-fatal"""
+    try:
+        # Authenticates, primes the module and context caches and opens
+        # the keep-alive connection to Odoo in one go
+        await get_odoo_context()
+    except Exception as e:
+        logger.warning(f"Odoo warmup failed: {str(e)}")
+    try:
+        # 1-token probe opens the TLS connection to the Anthropic API
+        await test_anthropic_connection()
+    except Exception as e:
+        logger.warning(f"Anthropic warmup failed: {str(e)}")
+
+@asynccontextmanager
+async def lifespan(app):
+    """Own the process-lifetime HTTP resources.
+
+    Startup pre-warms the Odoo session, the context cache and the
+    Anthropic connection so the first chat after boot hits warm caches;
+    a cold dependency only logs a warning and the first request retries.
+    """
+    try:
+        await _warmup()
+        yield
+    finally:
+        global _ODOO_HTTP
+        if _ODOO_HTTP is not None:
+            await _ODOO_HTTP.aclose()
+            _ODOO_HTTP = None
+        await async_anthropic_client.close()
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+
+# Configure CORS
+app.add_middleware(
+    CORSMiddleware,
+    # Odoo frontend URL(s); parsed once at import
+    allow_origins=tuple(
+        o.strip() for o in os.getenv("CORS_ORIGINS", "http://localhost:8069").split(",")
+        if o.strip()),
+    allow_credentials=True,
+    allow_methods=["GET", "POST"],
+    allow_headers=["content-type", "x-api-key"],
+)
+
+# Odoo connection settings
+ODOO_URL = os.getenv("ODOO_URL", "http://web:8069")
+ODOO_DB = os.getenv("ODOO_DB", "HISEY")
+ODOO_USERNAME = os.getenv("ODOO_USERNAME", "cjhisey@gmail.com")
+ODOO_PASSWORD = os.getenv("ODOO_PASSWORD", "odoo")
+
+# Anthropic settings
+ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
+if not ANTHROPIC_API_KEY:
+    raise ValueError("ANTHROPIC_API_KEY environment variable is not set")
+
+# One shared async Anthropic client; building a client per call would redo
+# the httpx pool and TLS setup on every request.
+async_anthropic_client = anthropic.AsyncAnthropic(api_key=ANTHROPIC_API_KEY)
+
+# Global cap on concurrent Anthropic calls: a burst of users otherwise
+# piles straight into the API rate limit and correlated timeouts
+ANTHROPIC_MAX_CONCURRENCY = int(os.getenv("ANTHROPIC_MAX_CONCURRENCY", "16"))
+_ANTHROPIC_SEM = asyncio.Semaphore(ANTHROPIC_MAX_CONCURRENCY)
+
+class ChatMessage(BaseModel):
+    message: str
+    context: Optional[dict] = None
+    conversation_history: Optional[List[dict]] = None
+
+class DatabaseOperation(BaseModel):
+    model: str
+    method: str
+    args: List[Any]
+    kwargs: Dict[str, Any] = {}
+
+class OdooRPCError(Exception):
+    """Raised when the Odoo JSON-RPC endpoint returns an error payload"""
+
+    def __init__(self, error):
+        self.error = error or {}
+        message = self.error.get('data', {}).get('message') or self.error.get('message', 'Unknown error')
+        super().__init__(message)
+
+# Odoo is queried over JSON-RPC: payloads are a fraction of the size of the
+# equivalent XML-RPC envelopes and parse much faster. One async client is
+# shared by all requests so sockets stay alive and calls never block the
+# event loop; the lifespan handler closes it on shutdown.
+_ODOO_HTTP = None
+_JSONRPC_IDS = itertools.count(1)
+
+def _get_odoo_http():
+    global _ODOO_HTTP
+    if _ODOO_HTTP is None:
+        _ODOO_HTTP = httpx.AsyncClient(
+            base_url=ODOO_URL, timeout=30, http2=True,
+            limits=httpx.Limits(
+                max_connections=20,
+                max_keepalive_connections=10,
+                keepalive_expiry=300))
+    return _ODOO_HTTP
+
+async def _jsonrpc(service, method, args):
+    """Issue one JSON-RPC call against Odoo's /jsonrpc endpoint"""
+    payload = {
+        "jsonrpc": "2.0",
+        "method": "call",
+        "params": {"service": service, "method": method, "args": args},
+        "id": next(_JSONRPC_IDS),
+    }
+    response = await _get_odoo_http().post(
+        "/jsonrpc",
+        content=orjson.dumps(payload),
+        headers={"Content-Type": "application/json"})
+    response.raise_for_status()
+    data = orjson.loads(response.content)
+    if data.get("error"):
+        raise OdooRPCError(data["error"])
+    return data.get("result")
+
+# Cached Odoo uid, shared across requests. Authentication is a full RPC
+# round-trip, so we only redo it when the cache is empty or a call failed.
+_ODOO_UID = None
+_ODOO_UID_LOCK = asyncio.Lock()
+
+async def _odoo_authenticate():
+    """Authenticate against Odoo and return the uid"""
+    logger.info(f"Connecting to Odoo at {ODOO_URL} with database {ODOO_DB}")
+    uid = await _jsonrpc("common", "login", [ODOO_DB, ODOO_USERNAME, ODOO_PASSWORD])
+    if not uid:
+        raise Exception("Authentication failed. Please check your credentials and database name.")
+    logger.info("Successfully connected to Odoo")
+    return uid
+
+async def get_odoo_connection(force_refresh=False):
+    """Return the cached uid, authenticating only when needed"""
+    global _ODOO_UID
+    async with _ODOO_UID_LOCK:
+        if _ODOO_UID is None or force_refresh:
+            _ODOO_UID = await _odoo_authenticate()
+        return _ODOO_UID
+
+# Cap on concurrent execute_kw calls so a context fan-out cannot occupy
+# every Odoo worker at once
+ODOO_RPC_CONCURRENCY = int(os.getenv("ODOO_RPC_CONCURRENCY", "8"))
+_ODOO_RPC_SEM = asyncio.Semaphore(ODOO_RPC_CONCURRENCY)
+
+# Methods that change state: a transport error on one of these may have
+# committed server-side, so re-issuing the call risks a double write
+_NON_IDEMPOTENT_METHODS = frozenset({'create', 'write', 'unlink'})
+
+def _is_auth_error(error):
+    """True when a JSON-RPC error means our session/login went stale"""
+    name = (error or {}).get('data', {}).get('name', '')
+    return name in ('odoo.exceptions.AccessDenied',
+                    'odoo.http.SessionExpiredException')
+
+async def _execute_kw(model, method, args, kwargs=None):
+    """Run execute_kw over JSON-RPC, re-authenticating once on auth failure.
+
+    Application errors (bad field, access rule) propagate immediately, and
+    writes are never re-issued after a transport fault because the first
+    attempt may have committed.
+    """
+    uid = await get_odoo_connection()
+    async with _ODOO_RPC_SEM:
+        try:
+            return await _jsonrpc("object", "execute_kw",
+                                  [ODOO_DB, uid, ODOO_PASSWORD, model, method, args, kwargs or {}])
+        except OdooRPCError as e:
+            if not _is_auth_error(e.error):
+                raise
+            logger.warning(f"Odoo auth failure ({str(e)}), refreshing connection and retrying")
+        except httpx.HTTPError as e:
+            if method in _NON_IDEMPOTENT_METHODS:
+                raise
+            logger.warning(f"Odoo transport error ({str(e)}), refreshing connection and retrying")
+        uid = await get_odoo_connection(force_refresh=True)
+        return await _jsonrpc("object", "execute_kw",
+                              [ODOO_DB, uid, ODOO_PASSWORD, model, method, args, kwargs or {}])
+
+async def connect_to_odoo():
+    """Establish connection to Odoo instance"""
+    try:
+        return await get_odoo_connection()
+    except Exception as e:
+        logger.error(f"Error connecting to Odoo: {str(e)}")
+        raise
+
+# One row per Odoo RPC issued when the owning module is installed:
+# (module, section, key, model, method, args, kwargs)
+# search_read results are bounded and ordered newest-first so the payload
+# stays constant-size as the database grows; line-level models are
+# aggregated server-side with read_group instead of fetching raw rows.
+_SEARCH_KW = {'limit': 200, 'order': 'write_date desc'}
+
+_CONTEXT_QUERIES = [
+    ('stock', 'inventory', 'products', 'product.product', 'search_read',
+     [[['type', '=', 'product']]],
+     {'fields': ['name', 'qty_available', 'standard_price'], **_SEARCH_KW}),
+    ('stock', 'inventory', 'categories', 'product.category', 'search_read',
+     [[]],
+     {'fields': ['name'], **_SEARCH_KW}),
+    ('mrp', 'manufacturing', 'boms', 'mrp.bom', 'search_read',
+     [[]],
+     {'fields': ['product_tmpl_id', 'product_qty', 'code'], **_SEARCH_KW}),
+    ('mrp', 'manufacturing', 'workcenters', 'mrp.workcenter', 'search_read',
+     [[]],
+     {'fields': ['name', 'time_efficiency'], **_SEARCH_KW}),
+    ('mrp', 'manufacturing', 'production_orders', 'mrp.production', 'search_read',
+     [[['state', 'in', ['draft', 'confirmed', 'progress']]]],
+     {'fields': ['name', 'product_id', 'product_qty', 'state'], **_SEARCH_KW}),
+    ('sale', 'sales', 'orders', 'sale.order', 'search_read',
+     [[['state', 'in', ['draft', 'sent', 'sale']]]],
+     {'fields': ['name', 'partner_id', 'amount_total', 'state', 'date_order'], **_SEARCH_KW}),
+    ('sale', 'sales', 'order_totals_by_product', 'sale.order.line', 'read_group',
+     [[['order_id.state', 'in', ['draft', 'sent', 'sale']]],
+      ['price_subtotal:sum', 'product_uom_qty:sum'], ['product_id']],
+     {}),
+    ('sale', 'sales', 'customers', 'res.partner', 'search_read',
+     [[['customer_rank', '>', 0]]],
+     {'fields': ['name', 'email', 'phone', 'city'], **_SEARCH_KW}),
+    ('purchase', 'purchasing', 'orders', 'purchase.order', 'search_read',
+     [[['state', 'in', ['draft', 'sent', 'purchase']]]],
+     {'fields': ['name', 'partner_id', 'amount_total', 'state', 'date_order', 'date_planned'], **_SEARCH_KW}),
+    ('purchase', 'purchasing', 'order_totals_by_product', 'purchase.order.line', 'read_group',
+     [[['order_id.state', 'in', ['draft', 'sent', 'purchase']]],
+      ['price_subtotal:sum', 'product_qty:sum'], ['product_id']],
+     {}),
+    ('purchase', 'purchasing', 'suppliers', 'res.partner', 'search_read',
+     [[['supplier_rank', '>', 0]]],
+     {'fields': ['name', 'email', 'phone', 'city'], **_SEARCH_KW}),
+    ('account', 'accounting', 'invoices', 'account.move', 'search_read',
+     [[['move_type', 'in', ['out_invoice', 'in_invoice']], ['state', '!=', 'cancel']]],
+     {'fields': ['name', 'partner_id', 'amount_total', 'state', 'invoice_date', 'invoice_date_due', 'payment_state'], **_SEARCH_KW}),
+    ('account', 'accounting', 'invoice_totals_by_product', 'account.move.line', 'read_group',
+     [[['move_id.move_type', 'in', ['out_invoice', 'in_invoice']], ['move_id.state', '!=', 'cancel']],
+      ['price_subtotal:sum', 'quantity:sum'], ['product_id']],
+     {}),
+    ('account', 'accounting', 'payments', 'account.payment', 'search_read',
+     [[['state', '!=', 'cancel']]],
+     {'fields': ['name', 'partner_id', 'amount', 'payment_type', 'date', 'state'], **_SEARCH_KW}),
+    ('crm', 'crm', 'leads', 'crm.lead', 'search_read',
+     [[['type', '=', 'lead']]],
+     {'fields': ['name', 'partner_id', 'email_from', 'phone', 'stage_id', 'probability', 'expected_revenue', 'create_date'], **_SEARCH_KW}),
+    ('crm', 'crm', 'opportunities', 'crm.lead', 'search_read',
+     [[['type', '=', 'opportunity']]],
+     {'fields': ['name', 'partner_id', 'email_from', 'phone', 'stage_id', 'probability', 'expected_revenue', 'create_date'], **_SEARCH_KW}),
+    ('crm', 'crm', 'activities', 'mail.activity', 'search_read',
+     [[['res_model', '=', 'crm.lead']]],
+     {'fields': ['res_id', 'activity_type_id', 'summary', 'date_deadline', 'state'], **_SEARCH_KW}),
+    ('crm', 'crm', 'stages', 'crm.stage', 'search_read',
+     [[]],
+     {'fields': ['name', 'sequence', 'is_won'], 'limit': 200, 'order': 'sequence'}),
+    # True cardinalities via search_count: the bounded search_read rows
+    # above stop at 200, so without these the model would under-report
+    # totals on mature databases. Counting is cheap server-side.
+    ('stock', 'inventory', 'products_count', 'product.product', 'search_count',
+     [[['type', '=', 'product']]], {}),
+    ('sale', 'sales', 'orders_count', 'sale.order', 'search_count',
+     [[['state', 'in', ['draft', 'sent', 'sale']]]], {}),
+    ('sale', 'sales', 'customers_count', 'res.partner', 'search_count',
+     [[['customer_rank', '>', 0]]], {}),
+    ('purchase', 'purchasing', 'orders_count', 'purchase.order', 'search_count',
+     [[['state', 'in', ['draft', 'sent', 'purchase']]]], {}),
+    ('account', 'accounting', 'invoices_count', 'account.move', 'search_count',
+     [[['move_type', 'in', ['out_invoice', 'in_invoice']], ['state', '!=', 'cancel']]], {}),
+    ('crm', 'crm', 'leads_count', 'crm.lead', 'search_count',
+     [[['type', '=', 'lead']]], {}),
+    ('crm', 'crm', 'opportunities_count', 'crm.lead', 'search_count',
+     [[['type', '=', 'opportunity']]], {}),
+]
+
+# Keyword gate per context section: a message that mentions none of a
+# section's vocabulary does not need that section in its prompt, and a
+# message that mentions nothing ERP-related needs no context at all.
+_SECTION_PATTERNS = {
+    'inventory': re.compile(r"\b(stock|inventor|product|sku|warehouse|quantit|categor)", re.I),
+    'manufacturing': re.compile(r"\b(manufactur|production|bom|bill of material|work\s?cent)", re.I),
+    'sales': re.compile(r"\b(sale|sell|sold|order|quot|customer|revenue)", re.I),
+    'purchasing': re.compile(r"\b(purchas|supplier|vendor|procure|buy|restock)", re.I),
+    'accounting': re.compile(r"\b(invoice|payment|account|bill|due|paid|unpaid|overdue)", re.I),
+    'crm': re.compile(r"\b(lead|opportunit|pipeline|crm|prospect|activit|stage)", re.I),
+}
+
+def _relevant_sections(message, conversation_history=None):
+    """Which context sections the message plausibly refers to.
+
+    Returns None to mean "everything": follow-up turns can refer back to
+    earlier data without naming it, so filtering only applies to the
+    opening message of a conversation. An empty set means the message is
+    small talk and the Odoo fetch can be skipped entirely.
+    """
+    if conversation_history:
+        return None
+    return {name for name, pattern in _SECTION_PATTERNS.items()
+            if pattern.search(message)}
+
+# The installed-module set changes on the order of days, so it gets its own
+# much longer TTL than the data context below.
+MODULES_TTL = float(os.getenv("ODOO_MODULES_TTL", "3600"))
+_MODULES_CACHE = (0.0, None)
+
+async def _get_installed_modules():
+    """Return the set of installed module names, cached for MODULES_TTL seconds"""
+    global _MODULES_CACHE
+    ts, names = _MODULES_CACHE
+    if names is not None and time.monotonic() - ts < MODULES_TTL:
+        return names
+    installed_modules = await _execute_kw(
+        'ir.module.module', 'search_read',
+        [[['state', '=', 'installed']]],
+        {'fields': ['name']})
+    names = {m['name'] for m in installed_modules}
+    _MODULES_CACHE = (time.monotonic(), names)
+    return names
+
+# ERP master data changes on the scale of minutes, so the assembled context
+# is memoized for a short TTL instead of being refetched on every message.
+CONTEXT_TTL = float(os.getenv("ODOO_CONTEXT_TTL", "30"))
+_CTX_CACHE = {}  # ODOO_DB -> (fetched_at, context, watermark)
+_CTX_CACHE_LOCK = asyncio.Lock()
+
+# Repeat questions (UI retries, recurring "status?" queries) are answered
+# from a small in-process cache instead of a fresh generation. The key
+# covers the normalized message, the recent history and the context
+# snapshot, so answers cannot leak across data changes.
+RESPONSE_CACHE_TTL = float(os.getenv("CHAT_RESPONSE_CACHE_TTL", "60"))
+_RESPONSE_CACHE = {}  # key -> (cached_at, response)
+_RESPONSE_CACHE_MAX = 256
+
+def _response_cache_key(message, conversation_history, context):
+    payload = orjson.dumps([
+        " ".join(message.lower().split()),
+        (conversation_history or [])[-4:],
+        _CTX_CACHE.get(ODOO_DB, (0,))[0],
+    ])
+    return hashlib.blake2b(payload, digest_size=16).digest()
+
+def _response_cache_get(key):
+    entry = _RESPONSE_CACHE.get(key)
+    if entry is not None and time.monotonic() - entry[0] < RESPONSE_CACHE_TTL:
+        return entry[1]
+    return None
+
+def _response_cache_put(key, response):
+    if len(_RESPONSE_CACHE) >= _RESPONSE_CACHE_MAX:
+        # Evict the older half; entries expire within a minute anyway
+        for old_key in sorted(_RESPONSE_CACHE,
+                              key=lambda k: _RESPONSE_CACHE[k][0])[:_RESPONSE_CACHE_MAX // 2]:
+            del _RESPONSE_CACHE[old_key]
+    _RESPONSE_CACHE[key] = (time.monotonic(), response)
+
+# Resending the whole transcript makes per-turn token cost grow linearly
+# with session length, so only the most recent turns are forwarded.
+MAX_HISTORY_TURNS = int(os.getenv("CHAT_MAX_HISTORY_TURNS", "20"))
+
+# Prompt-side projection: only the most informative rows per section reach
+# the LLM, with a sibling <key>_total carrying the full count.
+CONTEXT_MAX_ROWS = int(os.getenv("CONTEXT_MAX_ROWS", "50"))
+_MAX_FIELD_LEN = 80
+
+def _trim_record(record):
+    """Clamp long string fields so one verbose record cannot bloat the prompt"""
+    if not isinstance(record, dict):
+        return record
+    return {k: (v[:_MAX_FIELD_LEN] if isinstance(v, str) and len(v) > _MAX_FIELD_LEN else v)
+            for k, v in record.items()}
+
+def _trim_context(context):
+    """Bound each context section to CONTEXT_MAX_ROWS rows plus a total count"""
+    trimmed = {}
+    for section, data in context.items():
+        out = {}
+        for key, items in data.items():
+            if isinstance(items, list):
+                # For monetary records the largest amounts are the most
+                # informative rows, otherwise keep the fetch order
+                # (newest first)
+                if items and isinstance(items[0], dict) and 'amount_total' in items[0]:
+                    items = sorted(items, key=lambda r: r.get('amount_total') or 0, reverse=True)
+                out[key] = [_trim_record(r) for r in items[:CONTEXT_MAX_ROWS]]
+                # The fetch itself stops at 200 rows, so this is only the
+                # sample size; grand totals come from the search_count
+                # probes (<key>_count), never from here
+                out[f"{key}_rows_shown"] = len(out[key])
+            else:
+                out[key] = items
+        trimmed[section] = out
+    return trimmed
+
+async def _context_watermark(installed_module_names):
+    """Cheap change detector: newest write_date per context model.
+
+    One limit=1 probe per distinct model is far cheaper than refetching
+    the full context, and lets an expired cache entry be revalidated
+    instead of rebuilt when nothing changed in Odoo.
+    """
+    models = sorted({row[3] for row in _CONTEXT_QUERIES
+                     if row[0] in installed_module_names and row[4] == 'search_read'})
+    probes = await asyncio.gather(
+        *(_execute_kw(model, 'search_read', [[]],
+                      {'fields': ['write_date'], 'limit': 1, 'order': 'write_date desc'})
+          for model in models),
+        return_exceptions=True)
+    return tuple(rows[0].get('write_date') if isinstance(rows, list) and rows else None
+                 for rows in probes)
+
+async def get_odoo_context():
+    """Get current context from Odoo, memoized for CONTEXT_TTL seconds.
+
+    Expired entries are revalidated against a write_date watermark and
+    reused when the underlying models have not changed.
+    """
+    # The lock doubles as single-flight: one caller refreshes an expired
+    # entry while concurrent callers wait and then read the fresh cache.
+    async with _CTX_CACHE_LOCK:
+        cached = _CTX_CACHE.get(ODOO_DB)
+        if cached is not None and time.monotonic() - cached[0] < CONTEXT_TTL:
+            return cached[1]
+        if cached is not None:
+            try:
+                watermark = await _context_watermark(await _get_installed_modules())
+                if watermark == cached[2]:
+                    _CTX_CACHE[ODOO_DB] = (time.monotonic(), cached[1], watermark)
+                    return cached[1]
+            except Exception as e:
+                logger.warning(f"Context watermark probe failed: {str(e)}")
+        context = _trim_context(await _fetch_odoo_context())
+        if context:
+            try:
+                watermark = await _context_watermark(await _get_installed_modules())
+            except Exception:
+                watermark = None
+            _CTX_CACHE[ODOO_DB] = (time.monotonic(), context, watermark)
+        return context
+
+async def _fetch_odoo_context():
+    """Assemble the context dict from Odoo (uncached)"""
+    try:
+        logger.info("Fetching data...")
+        context = {}
+
+        # Check which modules are installed (cached, changes rarely)
+        installed_module_names = await _get_installed_modules()
+        logger.debug("Installed modules: %s", installed_module_names)
+
+        entries = [row for row in _CONTEXT_QUERIES if row[0] in installed_module_names]
+        if not entries:
+            logger.info("No context-relevant modules installed")
+            return context
+
+        # With our companion addon installed, one server-side call collects
+        # every section in a single round-trip
+        if 'ai_agent_odoo' in installed_module_names:
+            try:
+                snapshot = await _execute_kw(
+                    'ai.agent', 'get_context_snapshot',
+                    [[list(row[1:]) for row in entries]], {})
+                # The helper skips queries that fail server-side, so only
+                # trust a snapshot that answered every entry
+                if snapshot and all(key in snapshot.get(section, {})
+                                    for _, section, key, *_ in entries):
+                    return snapshot
+                logger.warning("Context snapshot incomplete, falling back to fan-out")
+            except Exception as e:
+                logger.warning(f"Batched context snapshot failed, falling back to fan-out: {str(e)}")
+
+        # Otherwise fan the queries out concurrently; the wall clock is
+        # then the slowest call rather than the sum
+        results = await asyncio.gather(
+            *(_execute_kw(model, method, args, kwargs)
+              for _, _, _, model, method, args, kwargs in entries),
+            return_exceptions=True)
+
+        for (_, section, key, *_), result in zip(entries, results):
+            if isinstance(result, Exception):
+                # Skip just this entry; the other sections still load
+                logger.error(f"Error fetching {section}.{key}: {str(result)}")
+                continue
+            context.setdefault(section, {})[key] = result
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Retrieved context: %s", orjson.dumps(context).decode())
+        return context
+    except Exception as e:
+        logger.error(f"Error getting Odoo context: {str(e)}")
+        logger.error(f"Error type: {type(e)}")
+        logger.error(f"Error args: {e.args}")
+        return {}
+
+async def test_anthropic_connection():
+    """Test the connection to Anthropic API"""
+    try:
+        logger.info("Testing Anthropic API connection...")
+
+        # A 1-token probe is enough to prove auth + connectivity and costs
+        # next to nothing compared to the previous 100-token test message
+        response = await async_anthropic_client.messages.create(
+            model="claude-3-5-haiku-20241022",
+            max_tokens=1,
+            messages=[
+                {"role": "user", "content": "ping"}
+            ]
+        )
+        logger.info("Anthropic API connection successful!")
+        return True
+    except Exception as e:
+        logger.error(f"Anthropic API connection failed: {str(e)}")
+        logger.error(f"Error type: {type(e)}")
+        logger.error(f"Error args: {e.args}")
+        return False
+
+async def execute_database_operation(operation: DatabaseOperation):
+    """Execute a database operation safely"""
+    try:
+        logger.info("Executing database operation: %s.%s", operation.model, operation.method)
+        logger.debug("Args: %s", operation.args)
+        logger.debug("Kwargs: %s", operation.kwargs)
+
+        # Execute the operation on the cached connection
+        result = await _execute_kw(
+            operation.model,
+            operation.method,
+            operation.args,
+            operation.kwargs
+        )
+        
+        logger.info("Operation successful")
+        logger.debug("Operation result: %s", result)
+        return result
+    except Exception as e:
+        logger.error(f"Error executing database operation: {str(e)}")
+        logger.error(f"Error type: {type(e)}")
+        logger.error(f"Error args: {e.args}")
+        raise
+
+# Static part of the system prompt, built once per process. It is sent as
+# its own system block marked with cache_control so Anthropic reuses the
+# server-side prompt cache across turns; only the context block varies.
+_SYSTEM_PROMPT_STATIC = """You are an AI assistant for an Odoo ERP system.
+You are given the current system context in a separate system block.
+
+Your task is to help users with their ERP operations. You can:
+1. Answer questions about inventory levels, products, and categories
+2. Help with manufacturing processes, BOMs, and work centers
+3. Provide information about sales orders and customers
+4. Assist with purchase orders and supplier information
+5. Help with accounting, invoices, and payments
+6. Provide insights about the data and suggest actions
+7. Analyze relationships between different aspects of the business
+8. Make changes to the database when requested
+
+When making changes to the database, you should:
+1. First confirm the change with the user
+2. Call the execute_odoo_operation tool with the model, method and args
+3. Provide clear feedback about what was changed
+
+Examples:
+- Create a new lead: model "crm.lead", method "create", args [[{"name": "New Lead", "partner_id": 1}]]
+- Update a lead: model "crm.lead", method "write", args [[1], {"name": "Updated Lead"}]
+- Delete a lead: model "crm.lead", method "unlink", args [[1]]
+
+Always be professional and precise in your responses. When providing information:
+- Use specific numbers and data from the context when available
+- Explain your reasoning when making suggestions
+- Highlight any potential issues or concerns
+- Suggest next steps when appropriate
+
+IMPORTANT: Maintain context from previous messages in the conversation. If the user refers to something
+mentioned earlier (like a specific lead, customer, or order), use that information to provide relevant responses."""
+
+# Appended on /chat/stream, which does not pass tools=: without it the
+# static prompt would tell the model to call a tool it cannot reach and
+# it would narrate writes that never execute.
+_STREAM_NO_TOOLS_NOTE = """Database changes are NOT available in this conversation: the
+execute_odoo_operation tool cannot be called here. If the user asks to create,
+update or delete a record, explain that changes must be made through the
+standard (non-streaming) chat and do not describe the change as done."""
+
+# The cached context dict is reused across requests within the TTL, so its
+# serialized form is memoized by object identity and recomputed only when
+# the cache refreshes.
+_CTX_STR_CACHE = (None, "")
+
+def _format_context(context):
+    """Serialize the context dict for the system prompt (single pass, memoized)"""
+    global _CTX_STR_CACHE
+    if context is _CTX_STR_CACHE[0]:
+        return _CTX_STR_CACHE[1]
+    text = orjson.dumps(context, default=str, option=orjson.OPT_INDENT_2).decode() if context else ""
+    _CTX_STR_CACHE = (context, text)
+    return text
+
+def _build_llm_request(message, context, conversation_history):
+    """Build the (system blocks, messages) pair shared by both LLM paths"""
+    context_str = _format_context(context)
+    logger.debug("Formatted context being sent to LLM: %s", context_str)
+
+    # Static instructions first (cache-stable prefix), dynamic context in
+    # a separate uncached block
+    # The context string is stable for the lifetime of a context-cache
+    # entry, so it gets its own cache breakpoint: repeat chats within the
+    # TTL window hit the server-side KV cache for the whole prefix
+    system_blocks = [
+        {"type": "text", "text": _SYSTEM_PROMPT_STATIC,
+         "cache_control": {"type": "ephemeral"}},
+        {"type": "text", "text": f"Current system context:\n{context_str}",
+         "cache_control": {"type": "ephemeral"}},
+    ]
+
+    messages = []
+    if conversation_history:
+        history = list(conversation_history[-MAX_HISTORY_TURNS:])
+        dropped = len(conversation_history) - len(history)
+        # Start the window on a user turn so the transcript keeps
+        # alternating roles after truncation
+        while history and history[0].get("role") == "assistant":
+            history.pop(0)
+            dropped += 1
+        if dropped:
+            system_blocks.append({
+                "type": "text",
+                "text": f"Note: {dropped} earlier conversation message(s) were omitted "
+                        "to keep the transcript short. Ask the user to restate anything "
+                        "important that appears to be missing."})
+        messages.extend(history)
+    messages.append({"role": "user", "content": message})
+    return system_blocks, messages
+
+# Database writes are exposed to Claude as a native tool instead of the old
+# DATABASE_OPERATION text marker: the schema lives in a structured (and
+# cacheable) field and the model returns tool_use blocks that need no
+# string matching. It also means operations run exactly once, server-side.
+_ODOO_TOOLS = [{
+    "name": "execute_odoo_operation",
+    "description": "Execute a write operation on an Odoo model after the user "
+                   "has confirmed it. Supports create, write and unlink.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "model": {"type": "string",
+                      "description": "Odoo model name, e.g. crm.lead"},
+            "method": {"type": "string",
+                       "enum": ["create", "write", "unlink"]},
+            "args": {"type": "array",
+                     "description": "Positional arguments for the method"},
+            "kwargs": {"type": "object",
+                       "description": "Optional keyword arguments"},
+        },
+        "required": ["model", "method", "args"],
+    },
+    "cache_control": {"type": "ephemeral"},
+}]
+
+async def process_with_llm(message: str, context: dict, conversation_history: List[dict] = None):
+    """Process the message with Claude, executing any requested tool calls.
+
+    Returns (response text, tool_used flag); tool-using responses must not
+    be served from the response cache.
+    """
+    try:
+        system_blocks, messages = _build_llm_request(message, context, conversation_history)
+        logger.info("Sending request to Anthropic API...")
+        async with _ANTHROPIC_SEM:
+            response = await async_anthropic_client.messages.create(
+                model="claude-3-5-haiku-20241022",
+                max_tokens=2000,
+                system=system_blocks,
+                tools=_ODOO_TOOLS,
+                messages=messages
+            )
+
+        tool_used = False
+        rounds = 0
+        # Resolve tool calls until the model settles on a text answer,
+        # with a small cap as a safety net
+        while response.stop_reason == "tool_use" and rounds < 3:
+            rounds += 1
+            tool_used = True
+            tool_results = []
+            for block in response.content:
+                if block.type != "tool_use":
+                    continue
+                try:
+                    operation = DatabaseOperation.model_validate(block.input)
+                    result = await execute_database_operation(operation)
+                    tool_results.append({
+                        "type": "tool_result",
+                        "tool_use_id": block.id,
+                        "content": orjson.dumps(result, default=str).decode(),
+                    })
+                except Exception as e:
+                    logger.error(f"Error executing tool call: {str(e)}")
+                    tool_results.append({
+                        "type": "tool_result",
+                        "tool_use_id": block.id,
+                        "content": f"Error: {str(e)}",
+                        "is_error": True,
+                    })
+            messages.append({"role": "assistant", "content": response.content})
+            messages.append({"role": "user", "content": tool_results})
+            async with _ANTHROPIC_SEM:
+                response = await async_anthropic_client.messages.create(
+                    model="claude-3-5-haiku-20241022",
+                    max_tokens=2000,
+                    system=system_blocks,
+                    tools=_ODOO_TOOLS,
+                    messages=messages
+                )
+
+        logger.info("Received response from Anthropic API")
+        text = "".join(block.text for block in response.content if block.type == "text")
+        return text, tool_used
+    except Exception as e:
+        logger.error(f"Error in LLM processing: {str(e)}")
+        logger.error(f"Error type: {type(e)}")
+        logger.error(f"Error args: {e.args}")
+        raise
+
+# Per-client token bucket for the chat endpoints: refilled lazily on
+# access, so there is no periodic scan, and state lives on the single
+# event loop so no lock is needed. RATE_LIMIT_RPS <= 0 disables it.
+RATE_LIMIT_RPS = float(os.getenv("RATE_LIMIT_RPS", "2"))
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "5"))
+_RATE_BUCKETS = {}  # client -> (last_refill, tokens)
+
+# Buckets idle long enough to be full again carry no information, so
+# they are evicted through a min-heap of (expiry, client) entries popped
+# lazily on access: cleanup costs O(expired), never a full-dict scan.
+# Stale heap entries for still-active clients are simply skipped.
+_RATE_IDLE_TTL = RATE_LIMIT_BURST / RATE_LIMIT_RPS if RATE_LIMIT_RPS > 0 else 0.0
+_RATE_EXPIRY_HEAP = []
+
+# Optional shared-secret gate for the chat endpoints: API_KEYS holds a
+# comma-separated list, hashed once at import. Comparing fixed-length
+# SHA-256 digests with hmac.compare_digest keeps the check constant-time
+# regardless of how much of a guessed key matches. Unset leaves the
+# endpoints open, matching the default docker-compose setup on a
+# trusted network.
+_API_KEY_DIGESTS = tuple(
+    hashlib.sha256(k.strip().encode()).digest()
+    for k in os.getenv("API_KEYS", "").split(",") if k.strip())
+
+async def _verify_api_key(request: Request):
+    """FastAPI dependency checking the X-API-Key header when keys are set"""
+    if not _API_KEY_DIGESTS:
+        return
+    digest = hashlib.sha256(request.headers.get("x-api-key", "").encode()).digest()
+    if not any(hmac.compare_digest(d, digest) for d in _API_KEY_DIGESTS):
+        raise HTTPException(status_code=401, detail="Invalid API key")
+
+async def _rate_limit(request: Request):
+    """FastAPI dependency enforcing the per-client token bucket"""
+    if RATE_LIMIT_RPS <= 0:
+        return
+    client = request.client.host if request.client else "unknown"
+    now = time.monotonic()
+    last, tokens = _RATE_BUCKETS.get(client, (now, RATE_LIMIT_BURST))
+    tokens = min(RATE_LIMIT_BURST, tokens + (now - last) * RATE_LIMIT_RPS)
+    if tokens < 1.0:
+        retry_after = max(1, round((1.0 - tokens) / RATE_LIMIT_RPS))
+        raise HTTPException(status_code=429, detail="Too many requests",
+                            headers={"Retry-After": str(retry_after)})
+    _RATE_BUCKETS[client] = (now, tokens - 1.0)
+    heapq.heappush(_RATE_EXPIRY_HEAP, (now + _RATE_IDLE_TTL, client))
+    while _RATE_EXPIRY_HEAP and _RATE_EXPIRY_HEAP[0][0] <= now:
+        _, stale = heapq.heappop(_RATE_EXPIRY_HEAP)
+        entry = _RATE_BUCKETS.get(stale)
+        if entry is not None and now - entry[0] >= _RATE_IDLE_TTL:
+            del _RATE_BUCKETS[stale]
+
+# In-flight cap per client on top of the frequency limiter: the token
+# bucket lets short bursts through, so a slow LLM turn could still stack
+# unbounded concurrent work for one client. Counts self-clean at zero,
+# and the yield ensures streamed responses stay counted until done.
+MAX_CONCURRENT_PER_CLIENT = int(os.getenv("MAX_CONCURRENT_PER_CLIENT", "4"))
+_INFLIGHT = {}  # client -> active request count
+
+async def _concurrency_limit(request: Request):
+    """FastAPI dependency rejecting clients with too many open requests"""
+    if MAX_CONCURRENT_PER_CLIENT <= 0:
+        yield
+        return
+    client = request.client.host if request.client else "unknown"
+    if _INFLIGHT.get(client, 0) >= MAX_CONCURRENT_PER_CLIENT:
+        raise HTTPException(status_code=429, detail="Too many concurrent requests",
+                            headers={"Retry-After": "1"})
+    _INFLIGHT[client] = _INFLIGHT.get(client, 0) + 1
+    try:
+        yield
+    finally:
+        remaining = _INFLIGHT.get(client, 1) - 1
+        if remaining <= 0:
+            _INFLIGHT.pop(client, None)
+        else:
+            _INFLIGHT[client] = remaining
+
+# Health probes arrive from several monitors; one cached result per
+# window keeps them from stacking up real Odoo/Anthropic calls
+PING_CACHE_TTL = float(os.getenv("PING_CACHE_TTL", "5"))
+_PING_CACHE = (0.0, None)
+
+@app.get("/ping")
+async def ping():
+    """Test endpoint to verify service health"""
+    global _PING_CACHE
+    try:
+        ts, cached = _PING_CACHE
+        if cached is not None and time.monotonic() - ts < PING_CACHE_TTL:
+            return cached
+
+        # Probe both services concurrently
+        async def check_odoo():
+            try:
+                await connect_to_odoo()
+                return True
+            except Exception as e:
+                logger.error(f"Odoo connection failed: {str(e)}")
+                return False
+
+        anthropic_connected, odoo_connected = await asyncio.gather(
+            test_anthropic_connection(),
+            check_odoo())
+
+        result = {
+            "status": "ok",
+            "anthropic_connected": anthropic_connected,
+            "odoo_connected": odoo_connected
+        }
+        _PING_CACHE = (time.monotonic(), result)
+        return result
+    except Exception as e:
+        logger.error(f"Ping test failed: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/chat/stream", dependencies=[Depends(_verify_api_key), Depends(_rate_limit), Depends(_concurrency_limit)])
+async def chat_stream(message: ChatMessage):
+    """Streaming variant of /chat: forwards tokens over SSE as they arrive.
+
+    First-token latency stays constant regardless of response length.
+    Database writes are not executed on this path; clients that need
+    tool-backed operations should keep using /chat.
+    """
+    sections = _relevant_sections(message.message, message.conversation_history)
+    context = await get_odoo_context() if sections is None or sections else {}
+    if sections:
+        context = {k: v for k, v in context.items() if k in sections}
+    system_blocks, messages = _build_llm_request(
+        message.message, context, message.conversation_history)
+    # After the cache breakpoints so the shared prefix still caches
+    system_blocks = system_blocks + [{"type": "text", "text": _STREAM_NO_TOOLS_NOTE}]
+
+    async def event_stream():
+        try:
+            # Held for the duration of the stream: an in-flight stream
+            # occupies a connection just like a buffered call
+            async with _ANTHROPIC_SEM, async_anthropic_client.messages.stream(
+                model="claude-3-5-haiku-20241022",
+                max_tokens=2000,
+                system=system_blocks,
+                messages=messages
+            ) as stream:
+                async for text in stream.text_stream:
+                    yield f"data: {orjson.dumps({'delta': text}).decode()}\n\n"
+            yield "data: [DONE]\n\n"
+        except Exception as e:
+            logger.error(f"Error streaming LLM response: {str(e)}")
+            yield f"data: {orjson.dumps({'error': str(e)}).decode()}\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+@app.post("/chat", dependencies=[Depends(_verify_api_key), Depends(_rate_limit), Depends(_concurrency_limit)])
+async def chat(message: ChatMessage):
+    try:
+        logger.info("Received chat message: %s", message.message)
+        logger.debug("Message context: %s", message.context)
+        logger.debug("Conversation history: %s", message.conversation_history)
+        
+        # Get current Odoo context, restricted to the sections the
+        # message actually talks about (or skipped for small talk)
+        logger.info("Fetching Odoo context...")
+        sections = _relevant_sections(message.message, message.conversation_history)
+        context = await get_odoo_context() if sections is None or sections else {}
+        if sections:
+            context = {k: v for k, v in context.items() if k in sections}
+
+        # Short-circuit repeat questions against the same context snapshot
+        cache_key = _response_cache_key(
+            message.message, message.conversation_history, context)
+        cached_response = _response_cache_get(cache_key)
+        if cached_response is not None:
+            logger.info("Returning cached response")
+            return {"response": cached_response}
+
+        # Process the message with LLM; tool calls (database writes) are
+        # executed inside process_with_llm and reflected in the answer
+        logger.info("Processing message with LLM...")
+        response, tool_used = await process_with_llm(
+            message.message, context, message.conversation_history)
+
+        # Only read-only answers are safe to replay from the cache
+        if not tool_used:
+            _response_cache_put(cache_key, response)
+
+        return {"response": response}
+    except Exception as e:
+        logger.error(f"Error in chat endpoint: {str(e)}")
+        logger.error(f"Error type: {type(e)}")
+        logger.error(f"Error args: {e.args}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+if __name__ == "__main__":
+    import uvicorn
+    # uvloop + httptools speed up the event loop and HTTP parsing; one
+    # worker per core scales /chat throughput (caches are per-worker)
+    uvicorn.run("app:app", host="0.0.0.0", port=8000,
+                loop="uvloop", http="httptools",
+                workers=int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1)))) 
\ No newline at end of file